@@ -1,16 +1,101 @@
 import os
+import threading
 from datetime import datetime
-from io import BytesIO
+from operator import itemgetter
 import uuid
 
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
+import torch
 from sentence_transformers import SentenceTransformer
 from qdrant_client import models, QdrantClient
 
 
+def parse_news_feed(content):
+    """
+    Decode a raw news API response and extract the title and URL of every article in its feed.
+
+    :param content: Raw JSON bytes of the news API response
+    :return: List of tuples containing article titles and URLs
+    """
+    return list(map(itemgetter('title', 'url'), _loads(content).get('feed', [])))
+
+
+class OnnxSentenceEncoder:
+    def __init__(self, model_path, file_name="model_quantized.onnx"):
+        """
+        Initialize a sentence encoder backed by an ONNX Runtime export of a sentence-transformers model.
+
+        The model directory is produced once, outside of this script, e.g.:
+            optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 --task feature-extraction onnx_minilm/
+        followed by onnxruntime.quantization.quantize_dynamic on onnx_minilm/model.onnx to write the int8 weights
+        to onnx_minilm/model_quantized.onnx.
+
+        :param model_path: Directory containing the exported ONNX model and its tokenizer files
+        :param file_name: Name of the ONNX file to load from the model directory
+        """
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        session_options = onnxruntime.SessionOptions()
+        # 0 lets ONNX Runtime pick the thread count when the CPU count is unknown
+        session_options.intra_op_num_threads = os.cpu_count() or 0
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_path, file_name=file_name,
+                                                                  provider="CPUExecutionProvider",
+                                                                  session_options=session_options)
+
+    def get_sentence_embedding_dimension(self):
+        """
+        :return: Size of the embeddings produced by the model
+        """
+        return self.model.config.hidden_size
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        """
+        Encode sentences into mean-pooled embeddings, matching SentenceTransformer.encode output.
+
+        :param sentences: List of sentences to encode
+        :param batch_size: Number of sentences passed to the model at once
+        :param normalize_embeddings: Whether to L2-normalize the returned embeddings
+        :return: Array of shape (len(sentences), embedding dimension)
+        """
+        embeddings = []
+        for start in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(sentences[start:start + batch_size], padding=True, truncation=True,
+                                    max_length=256, return_tensors="np")
+            last_hidden_state = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            embeddings.append((last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        embeddings = np.concatenate(embeddings).astype(np.float32)
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+
 class ShortPositionAnalyzer:
+    EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+    EMBEDDING_SIZE = 384
+
+    # Encoders are loaded on first use and shared by all analyzers in the process, keyed by ONNX model path
+    _encoders = {}
+    _encoders_lock = threading.Lock()
+
     def __init__(self, config_path, secrets_path):
         """
         Initialize the ShortPositionAnalyzer with configuration and secrets files.
@@ -19,22 +104,60 @@ class ShortPositionAnalyzer:
         :param secrets_path: Path to the YAML secrets file containing API keys for external services
         """
         with open(config_path, 'r') as file:
-            config = yaml.safe_load(file)
+            config = yaml.load(file, Loader=SafeLoader)
         with open(secrets_path, 'r') as file:
-            secrets = yaml.safe_load(file)
+            secrets = yaml.load(file, Loader=SafeLoader)
 
         self.url = config.get('url')
         self.destfile = config.get('destfile')
         self.news_endpoint = config.get('news_endpoint')
+        self.llm_inference_endpoint = config.get('llm_inference_endpoint')
+        self.onnx_model_path = config.get('onnx_model_path')
 
         self.news_api_key = secrets.get('news_api_key')
         self.hugging_face_token = secrets.get('hugging_face_user_token')
 
-        # Initialize Qdrant client and sentence transformer model
+        # Initialize a pooled HTTP session shared by all outgoing requests
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                              max_retries=Retry(total=3, backoff_factor=0.2))
+        self.http.mount("https://", adapter)
+
+        # Initialize Qdrant client; the sentence transformer model is loaded lazily by the encoder property
         self.qdrant = QdrantClient(":memory:")
         self.COLLECTION_NAME = "Press news"
         self.DISTANCE = models.Distance.COSINE
-        self.encoder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        self._emb_cache = {}
+
+        self.qdrant.create_collection(
+            collection_name=self.COLLECTION_NAME,
+            vectors_config=models.VectorParams(size=self.EMBEDDING_SIZE, distance=self.DISTANCE),
+            hnsw_config=models.HnswConfigDiff(m=16, ef_construct=64),
+            on_disk_payload=False,
+        )
+
+    @property
+    def encoder(self):
+        """
+        Sentence encoder shared by every analyzer with the same model configuration, loaded on first access.
+
+        :return: SentenceTransformer, or OnnxSentenceEncoder when an ONNX model path is configured
+        """
+        key = self.onnx_model_path or None
+        encoder = ShortPositionAnalyzer._encoders.get(key)
+        if encoder is None:
+            with ShortPositionAnalyzer._encoders_lock:
+                encoder = ShortPositionAnalyzer._encoders.get(key)
+                if encoder is None:
+                    if key:
+                        encoder = OnnxSentenceEncoder(key)
+                    else:
+                        encoder = SentenceTransformer(self.EMBEDDING_MODEL).eval()
+                    if encoder.get_sentence_embedding_dimension() != self.EMBEDDING_SIZE:
+                        raise ValueError(f"Encoder produces {encoder.get_sentence_embedding_dimension()}-dimensional "
+                                         f"embeddings, but the collection expects {self.EMBEDDING_SIZE}")
+                    ShortPositionAnalyzer._encoders[key] = encoder
+        return encoder
 
     def download_file(self):
         """
@@ -45,27 +168,41 @@ class ShortPositionAnalyzer:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Encoding": "gzip, deflate, br",
+            "Accept-Encoding": "gzip, deflate",
             "Accept-Language": "en-US,en;q=0.5",
             "Connection": "keep-alive",
         }
         filename = rf'pnc_consob_{datetime.now().strftime("%d-%m-%y")}.xlsx'
+        filepath = os.path.join(self.destfile, filename)
+        position_columns = ['Position Date', 'ISIN', 'Position Holder', 'Net Short Position (%)', 'Share Issuer']
+        partpath = filepath + '.part'
+        os.makedirs(self.destfile, exist_ok=True)
         try:
-            response = requests.get(self.url, headers=headers, stream=True)
-            response.raise_for_status()
-            current = pd.read_excel(BytesIO(response.content), engine='openpyxl',
-                                    sheet_name=' Correnti - Current ', skiprows=1)
-            historical = pd.read_excel(BytesIO(response.content), engine='openpyxl',
-                                       sheet_name=' Storiche - Historic ', skiprows=1)
-            date_str = pd.read_excel(BytesIO(response.content), engine='openpyxl',
-                                     sheet_name=' Pubb. Data - Pubb. Date ', usecols="A").iloc[1].values[0]
-            self.pubblication_date = datetime.strptime(date_str, "%d/%m/%Y")
-            with open(os.path.join(self.destfile, filename), 'wb') as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
-            print(f"File downloaded successfully and saved to {self.destfile}")
+            # Stream into a temporary file so an interrupted download never leaves a truncated workbook behind
+            with self.http.get(self.url, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                with open(partpath, 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        file.write(chunk)
+            os.replace(partpath, filepath)
         except requests.exceptions.RequestException as e:
             print(f"An error occurred: {e}")
+            raise
+        finally:
+            if os.path.exists(partpath):
+                os.remove(partpath)
+        print(f"File downloaded successfully and saved to {self.destfile}")
+
+        with pd.ExcelFile(filepath, engine='openpyxl') as xl:
+            current = xl.parse(' Correnti - Current ', skiprows=1, usecols=position_columns)
+            historical = xl.parse(' Storiche - Historic ', skiprows=1, usecols=position_columns)
+            date_str = xl.parse(' Pubb. Data - Pubb. Date ', usecols="A", nrows=2).iloc[1].values[0]
+        self.pubblication_date = datetime.strptime(date_str, "%d/%m/%Y")
+        for positions in (current, historical):
+            for column in ('ISIN', 'Position Holder', 'Share Issuer'):
+                positions[column] = positions[column].astype('category')
+            positions['Net Short Position (%)'] = pd.to_numeric(positions['Net Short Position (%)'],
+                                                                downcast='float')
         return current, historical
 
     def analyze_positions(self, current, historical):
@@ -76,68 +213,99 @@ class ShortPositionAnalyzer:
         :param historical: DataFrame containing historical short positions
         :return: Tuple containing new positions, closed positions, and grouped positions by asset
         """
-        new_positions = current[current['Position Date'] == self.pubblication_date]
-        closed_positions = historical[historical['Position Date'] == self.pubblication_date]
-        short_positions_by_asset = current.groupby('ISIN').agg(
-            {'Position Holder': list, 'Net Short Position (%)': list, 'Share Issuer': 'first'}).reset_index()
+        # Text dates in the CONSOB workbook are day-first; cells that are not dates (e.g. footer rows) become NaT
+        current_dates = pd.to_datetime(current['Position Date'], dayfirst=True, errors='coerce').to_numpy()
+        historical_dates = pd.to_datetime(historical['Position Date'], dayfirst=True, errors='coerce').to_numpy()
+        pubblication_date = np.datetime64(self.pubblication_date, 'ns')
+
+        new_positions = current[current_dates == pubblication_date]
+        closed_positions = historical[historical_dates == pubblication_date]
+
+        # Group by ISIN with one stable sort of its integer codes and a split at each code change, dropping
+        # rows without an ISIN (code -1) as groupby does
+        codes, uniques = pd.factorize(current['ISIN'], sort=True)
+        rows = np.flatnonzero(codes >= 0)
+        order = rows[np.argsort(codes[rows], kind='stable')]
+        sorted_codes = codes[order]
+        boundaries = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+        starts = np.r_[0, boundaries] if len(sorted_codes) else boundaries
+        short_positions_by_asset = pd.DataFrame({'ISIN': np.asarray(uniques)[sorted_codes[starts]]})
+        for column in ('Position Holder', 'Net Short Position (%)'):
+            groups = np.split(current[column].to_numpy()[order], boundaries)[:len(starts)]
+            short_positions_by_asset[column] = pd.Series(groups, dtype=object)
+        short_positions_by_asset['Share Issuer'] = current['Share Issuer'].to_numpy()[order][starts]
         return new_positions, closed_positions, short_positions_by_asset
 
     def retrieve_news(self, company_name):
         """
         Retrieve the latest news articles for a given company.
 
-        :param company_name: Name of the company for which to retrieve news
+        :param company_name: Ticker of the company for which to retrieve news
         :return: List of tuples containing article titles and URLs
         """
-        response = requests.get(self.news_endpoint.format(company_name))
+        response = self.http.get(self.news_endpoint.format(ticker=company_name, api_key=self.news_api_key or "demo"))
         articles = []
         if response.status_code == 200:
-            feed = response.json().get('feed', [])
-            articles = [(item['title'], item['url']) for item in feed]
+            articles = parse_news_feed(response.content)
         return articles
 
-    def embed_and_store_news(self, articles):
+    def _encode(self, texts):
+        """
+        Encode texts with the sentence transformer, reusing embeddings already computed for identical texts.
+
+        :param texts: List of texts to encode
+        :return: Array of shape (len(texts), embedding dimension) with the normalized embeddings
+        """
+        missing = list(dict.fromkeys(text for text in texts if text not in self._emb_cache))
+        if missing:
+            with torch.inference_mode():
+                embeddings = self.encoder.encode(missing, batch_size=32, convert_to_numpy=True,
+                                                 normalize_embeddings=True, show_progress_bar=False)
+            self._emb_cache.update(zip(missing, embeddings))
+        return np.stack([self._emb_cache[text] for text in texts])
+
+    def embed_and_store_news(self, articles, company_name=None):
         """
         Embed news articles and store them in the vector database.
 
         :param articles: List of tuples containing article titles and URLs
+        :param company_name: Name of the company the articles were retrieved for
         """
-        if not self.qdrant.collection_exists(self.COLLECTION_NAME):
-            self.qdrant.create_collection(
-                collection_name=self.COLLECTION_NAME,
-                vectors_config=models.VectorParams(size=self.encoder.get_sentence_embedding_dimension(),
-                                                   distance=self.DISTANCE),
-            )
-
-        for title, url in articles:
-            embedding = self.encoder.encode(title).tolist()
-            unique_id = str(uuid.uuid4())
-            self.qdrant.upsert(
-                collection_name=self.COLLECTION_NAME,
-                points=[models.PointStruct(
-                    id=unique_id,
-                    vector=embedding,
-                    payload={"title": title, "url": url}
-                )]
-            )
+        if not articles:
+            return
+
+        titles = [title for title, _ in articles]
+        embeddings = self._encode(titles)
+
+        ids = [str(uuid.uuid4()) for _ in articles]
+        payload = [{"title": title, "url": url, "company": company_name} for title, url in articles]
+        self.qdrant.upload_collection(collection_name=self.COLLECTION_NAME, vectors=embeddings,
+                                      payload=payload, ids=ids, batch_size=64, wait=True)
 
     def retrieve_news_with_rag(self, company_name):
         """
         Retrieve latest news for a company and provide an explanation using RAG (Retrieval-Augmented Generation).
 
         :param company_name: Name of the company for which to retrieve news
-        :return: Explanation generated by the language model
+        :return: Explanation generated by the language model, or None when no relevant news article was found
         """
         articles = self.retrieve_news(company_name=company_name)
-        self.embed_and_store_news(articles)
+        self.embed_and_store_news(articles, company_name=company_name)
 
-        query_embedding = self.encoder.encode('Short selling').tolist()
-        results = self.qdrant.search(
+        query_embedding = self._encode(['Short selling'])[0]
+        results = self.qdrant.query_points(
             collection_name=self.COLLECTION_NAME,
-            query_vector=query_embedding,
+            query=query_embedding,
+            query_filter=models.Filter(must=[
+                models.FieldCondition(key="company", match=models.MatchValue(value=company_name))
+            ]),
             limit=5,
-            with_payload=True
-        )
+            with_payload=models.PayloadSelectorInclude(include=['title']),
+            with_vectors=False,
+            score_threshold=0.2
+        ).points
+        if not results:
+            return None
 
         article_summaries = "\n".join(
             [f"Title: {res.payload['title']}" for res in results]
@@ -149,21 +317,27 @@ class ShortPositionAnalyzer:
         )
 
         headers = {"Authorization": f"Bearer {self.hugging_face_token}"}
-        explanation = requests.post(self.llm_inference_endpoint, headers=headers, json={"inputs": prompt})
+        explanation = self.http.post(self.llm_inference_endpoint, headers=headers, json={"inputs": prompt})
 
         return explanation
 
-    def display_results(self, new_positions, closed_positions, short_positions_by_asset):
+    def display_results(self, new_positions, closed_positions, short_positions_by_asset, explanations=None):
         """
         Display the analyzed positions to the console.
 
         :param new_positions: DataFrame of new short positions
         :param closed_positions: DataFrame of closed short positions
         :param short_positions_by_asset: DataFrame of short positions grouped by asset
+        :param explanations: Optional dictionary mapping company names to language model explanations
         """
         print("New Short Positions:\n", new_positions)
         print("\nClosed Short Positions:\n", closed_positions)
         print("\nShort Positions by Asset:\n", short_positions_by_asset)
+        for company_name, explanation in (explanations or {}).items():
+            if explanation is None:
+                print(f"\nNo relevant news found for {company_name}")
+            else:
+                print(f"\nExplanation for {company_name}:\n", explanation.text)
 
     def execute(self):
         """
@@ -172,10 +346,13 @@ class ShortPositionAnalyzer:
         current, historical = self.download_file()
         new_positions, closed_positions, short_positions_by_asset = self.analyze_positions(current=current,
                                                                                            historical=historical)
-        self.retrieve_news_with_rag(company_name='AAPL')
+        explanation = self.retrieve_news_with_rag(company_name='AAPL')
         self.display_results(new_positions=new_positions, closed_positions=closed_positions,
-                             short_positions_by_asset=short_positions_by_asset)
+                             short_positions_by_asset=short_positions_by_asset, explanations={'AAPL': explanation})
 
 
-analyzer = ShortPositionAnalyzer(config_path="config.yaml", secrets_path="secrets.yaml")
-analyzer.execute()
+if __name__ == "__main__":
+    torch.set_num_threads(os.cpu_count() or 1)
+    torch.set_num_interop_threads(2)
+    analyzer = ShortPositionAnalyzer(config_path="config.yaml", secrets_path="secrets.yaml")
+    analyzer.execute()